@@ -1,26 +1,40 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, HttpUrl, field_validator
+from typing import Optional, Dict, Any, List, Tuple, Callable, Literal, NamedTuple
+from urllib.parse import quote, urlencode
+from weakref import WeakValueDictionary
+from contextlib import asynccontextmanager
+from cachetools import LRUCache, TTLCache
+from enum import Enum
+import asyncio
+import secrets
+import hmac
+import hashlib
 import os
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 import httpx
-from datetime import datetime
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-app = FastAPI(title="Roex Python Microservice", version="1.0.0")
-
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+# Configure logging: the calling thread only interpolates the message and
+# enqueues the record (QueueHandler.prepare); the stream handler's formatting
+# and I/O run on a listener thread, so log writes never block the event loop
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s"
 )
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *logging.root.handlers, respect_handler_level=True)
+logging.root.handlers = [QueueHandler(log_queue)]
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
 
 # Initialize Roex API configuration
 roex_api_key = os.getenv("ROEX_API_KEY")
@@ -29,298 +43,572 @@ if not roex_api_key:
     raise ValueError("ROEX_API_KEY environment variable not set")
 
 ROEX_API_BASE = "https://api.roexaudio.com/v1"
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Public URL of this service; when set, Roex calls back /roex/webhook on completion
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+# Key signing the registered webhook URL so forged callbacks are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+if PUBLIC_BASE_URL and not WEBHOOK_SECRET:
+    logger.error("WEBHOOK_SECRET environment variable not set")
+    raise ValueError("WEBHOOK_SECRET must be set when PUBLIC_BASE_URL is set")
+# Optional Redis shared by all workers for webhook results and job status
+REDIS_URL = os.getenv("REDIS_URL")
+# Seconds /status waits for the webhook before answering "processing"
+STATUS_LONG_POLL_TIMEOUT = float(os.getenv("STATUS_LONG_POLL_TIMEOUT", "25"))
+# Without Redis a webhook on another worker cannot wake a long-poll, so it
+# re-checks Roex at this interval instead
+STATUS_REPOLL_INTERVAL = 5.0
+
+# Status lookups arriving within this window are sent to Roex together
+STATUS_BATCH_WINDOW = 0.01
+STATUS_BATCH_SIZE = 32
+
+async def status_batcher(client: httpx.AsyncClient, status_queue: "asyncio.Queue[Tuple[str, asyncio.Future]]"):
+    """Collect queued status lookups into batches and dispatch them concurrently"""
+    inflight = set()
+    while True:
+        batch = [await status_queue.get()]
+        await asyncio.sleep(STATUS_BATCH_WINDOW)
+        while len(batch) < STATUS_BATCH_SIZE and not status_queue.empty():
+            batch.append(status_queue.get_nowait())
+        
+        # Dispatch in the background so a slow batch never holds up the next one
+        task = asyncio.create_task(dispatch_status_batch(client, batch))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+
+async def dispatch_status_batch(client: httpx.AsyncClient, batch: List[Tuple[str, asyncio.Future]]):
+    responses = await asyncio.gather(
+        *(client.get(path) for path, _ in batch),
+        return_exceptions=True
+    )
+    for (_, future), response in zip(batch, responses):
+        if future.done():
+            continue
+        if isinstance(response, BaseException):
+            future.set_exception(response)
+        else:
+            future.set_result(response)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Shared Roex client: one connection pool with keep-alive for every request.
+    # HTTP/2 multiplexes concurrent calls over one connection; HTTP/1.1 stays
+    # enabled as the fallback if the server does not negotiate h2
+    app.state.http = httpx.AsyncClient(
+        base_url=ROEX_API_BASE,
+        headers={"Authorization": f"Bearer {roex_api_key}"},
+        http1=True,
+        http2=True,
+        timeout=httpx.Timeout(connect=3.0, read=30.0, write=30.0, pool=5.0),
+        # Every connection goes to the same host, so keep them all alive rather
+        # than closing and re-handshaking above a lower keep-alive cap
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=200, keepalive_expiry=90.0)
+    )
+    # Separate client for caller webhooks so the Roex API key is never forwarded
+    app.state.callback_http = httpx.AsyncClient(timeout=httpx.Timeout(30.0))
+    # Short socket timeouts so an unreachable Redis falls back quickly instead
+    # of stalling requests until the OS connect timeout
+    app.state.redis = aioredis.Redis.from_url(
+        REDIS_URL,
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5
+    ) if REDIS_URL else None
+    app.state.status_queue = asyncio.Queue()
+    batcher = asyncio.create_task(status_batcher(app.state.http, app.state.status_queue))
+    yield
+    batcher.cancel()
+    await app.state.http.aclose()
+    await app.state.callback_http.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+app = FastAPI(
+    title="Roex Python Microservice",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+# Add CORS middleware: explicit origins (comma-separated ALLOWED_ORIGINS), and
+# browsers may cache preflight responses for a day
+ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "").split(",") if origin.strip()]
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["authorization", "content-type"],
+    max_age=86400,
+)
+
+# Musical styles accepted by Roex
+class MusicalStyle(str, Enum):
+    ROCK_INDIE = "ROCK_INDIE"
+    POP = "POP"
+    ACOUSTIC = "ACOUSTIC"
+    HIPHOP_GRIME = "HIPHOP_GRIME"
+    ELECTRONIC = "ELECTRONIC"
+    REGGAE_DUB = "REGGAE_DUB"
+    ORCHESTRAL = "ORCHESTRAL"
+    METAL = "METAL"
+    OTHER = "OTHER"
+
+ServiceType = Literal["mastering_full", "mixing_full", "mix_enhance", "mix_analysis", "cleanup"]
 
 # Pydantic models for requests
 class ProcessAudioRequest(BaseModel):
-    service_type: str
-    file_url: str
-    musical_style: Optional[str] = "POP"
-    webhook_url: Optional[str] = None
-    parameters: Optional[Dict[str, Any]] = {}
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    service_type: ServiceType
+    file_url: HttpUrl
+    musical_style: MusicalStyle = MusicalStyle.POP
+    webhook_url: Optional[HttpUrl] = None
+
+    @field_validator("musical_style", mode="before")
+    @classmethod
+    def normalize_musical_style(cls, value):
+        # Normalize once at parse time so unknown styles fail fast with a 422
+        if not value:
+            return MusicalStyle.POP
+        return value.upper() if isinstance(value, str) else value
 
 class JobStatusRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     job_id: str
-    service_type: str
+    service_type: ServiceType
+
+    @field_validator("job_id")
+    @classmethod
+    def reject_path_segments(cls, value):
+        # The id becomes a Roex path segment: "" would hit the collection and
+        # "." / ".." are normalised away, addressing other endpoints
+        if value in ("", ".", ".."):
+            raise ValueError("job_id must identify a single job")
+        return value
 
 class FileUploadRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     file_name: str
     content_type: str
 
-# Health check endpoint
+# Upstream and unexpected errors are mapped to responses in one place
+@app.exception_handler(httpx.HTTPStatusError)
+async def upstream_status_error(request: Request, exc: httpx.HTTPStatusError):
+    logger.warning("Roex returned HTTP %s for %s", exc.response.status_code, exc.request.url.path)
+    return ORJSONResponse(
+        status_code=502,
+        content={"success": False, "error": "upstream", "code": exc.response.status_code}
+    )
+
+@app.exception_handler(httpx.HTTPError)
+async def upstream_error(request: Request, exc: httpx.HTTPError):
+    logger.error("Roex request failed: %r", exc, exc_info=exc)
+    return ORJSONResponse(status_code=502, content={"success": False, "error": "upstream"})
+
+@app.exception_handler(Exception)
+async def unhandled_error(request: Request, exc: Exception):
+    # Starlette re-raises after this handler so the server logs the traceback
+    return ORJSONResponse(status_code=500, content={"success": False, "error": "internal"})
+
+# Roex request payloads, one builder per service
+def mastering_payload(request: ProcessAudioRequest) -> Dict[str, Any]:
+    return {
+        "track_url": str(request.file_url),
+        "musical_style": request.musical_style.value,
+        "desired_loudness": "MEDIUM",
+        "sample_rate": "44100"
+    }
+
+def mixing_payload(request: ProcessAudioRequest) -> Dict[str, Any]:
+    return {
+        "track_data": [{
+            "track_url": str(request.file_url),
+            "instrument_group": "VOCAL_GROUP",
+            "presence_setting": "LEAD",
+            "pan_preference": "CENTRE",
+            "reverb_preference": "LOW"
+        }],
+        "musical_style": request.musical_style.value,
+        "return_stems": False
+    }
+
+def track_payload(request: ProcessAudioRequest) -> Dict[str, Any]:
+    return {
+        "track_url": str(request.file_url)
+    }
+
+def cleanup_payload(request: ProcessAudioRequest) -> Dict[str, Any]:
+    return {
+        "audio_file_location": str(request.file_url),
+        "sound_source": "VOCAL_GROUP"  # Default to vocal cleanup
+    }
+
+class RoexService(NamedTuple):
+    submit_path: str
+    status_prefix: str
+    build_payload: Callable[[ProcessAudioRequest], Dict[str, Any]]
+    task_id_key: str
+
+# Map service types to Roex operations, built once at import time
+ROEX_SERVICES: Dict[str, RoexService] = {
+    "mastering_full": RoexService("/mastering/preview", "/mastering/preview/", mastering_payload, "mastering_task_id"),
+    "mixing_full": RoexService("/mix/preview", "/mix/preview/", mixing_payload, "multitrack_task_id"),
+    "mix_enhance": RoexService("/enhance", "/enhance/", track_payload, "enhance_task_id"),
+    "mix_analysis": RoexService("/analysis", "/analysis/", track_payload, "analysis_task_id"),
+    "cleanup": RoexService("/cleanup", "/cleanup/", cleanup_payload, "cleanup_task_id")
+}
+
+TASK_ID_KEYS = ("job_id",) + tuple(service.task_id_key for service in ROEX_SERVICES.values())
+
+# Job status caches: completed jobs never change, in-flight jobs are
+# debounced to one upstream lookup per STATUS_TTL window
+STATUS_TTL = 2
+DONE_TTL = 86400
+DONE_CACHE = LRUCache(maxsize=10_000)
+STATUS_CACHE = TTLCache(maxsize=10_000, ttl=STATUS_TTL)
+_status_inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+async def shared_set(name: str, value: bytes, ex: int):
+    """Write to Redis when configured; a failure only costs cross-worker sharing"""
+    redis = app.state.redis
+    if redis is None:
+        return
+    try:
+        await redis.set(name, value, ex=ex)
+    except RedisError:
+        logger.warning("Redis write of %s failed, continuing without it", name, exc_info=True)
+
+async def shared_job_status(service_type: str, job_id: str) -> Optional[Dict[str, Any]]:
+    """Look up a status result stored in Redis by any worker"""
+    redis = app.state.redis
+    if redis is None:
+        return None
+    
+    try:
+        done, recent = await redis.mget(f"roex:done:{job_id}", f"roex:status:{service_type}:{job_id}")
+    except RedisError:
+        logger.warning("Redis status lookup for job %s failed", job_id, exc_info=True)
+        return None
+    if done:
+        result = orjson.loads(done)
+        DONE_CACHE[(service_type, job_id)] = result
+        return result
+    return orjson.loads(recent) if recent else None
+
+# Roex webhook wake-ups, keyed by job_id
+WEBHOOK_EVENTS: "WeakValueDictionary[str, asyncio.Event]" = WeakValueDictionary()
+# Job ids whose callback this worker already handled (Redis covers all workers)
+HANDLED_WEBHOOKS = LRUCache(maxsize=10_000)
+
+def webhook_signature(service_type: str, callback: str) -> str:
+    return hmac.new(WEBHOOK_SECRET.encode(), f"{service_type}\n{callback}".encode(), hashlib.sha256).hexdigest()
+
+def attach_webhook(payload: Dict[str, Any], request: ProcessAudioRequest):
+    """Route Roex callbacks through this service when a public URL is configured"""
+    if PUBLIC_BASE_URL:
+        # The callback URL carries the service type and the caller's webhook,
+        # signed, so any worker can handle it without stored state
+        callback = str(request.webhook_url) if request.webhook_url else ""
+        query = urlencode({
+            "service_type": request.service_type,
+            "callback": callback,
+            "sig": webhook_signature(request.service_type, callback)
+        })
+        payload["webhook_url"] = f"{PUBLIC_BASE_URL}/roex/webhook?{query}"
+    elif request.webhook_url:
+        payload["webhook_url"] = str(request.webhook_url)
+
+async def first_webhook(job_id: str) -> bool:
+    """Record that job_id's callback arrived; False if it was already handled"""
+    if job_id in HANDLED_WEBHOOKS:
+        return False
+    HANDLED_WEBHOOKS[job_id] = True
+    
+    redis = app.state.redis
+    if redis is None:
+        return True
+    try:
+        return bool(await redis.set(f"roex:webhook:{job_id}", 1, nx=True, ex=DONE_TTL))
+    except RedisError:
+        logger.warning("Redis webhook marker for job %s failed", job_id, exc_info=True)
+        return True
+
+def webhook_job_id(payload: Dict[str, Any]) -> Optional[str]:
+    """Extract the task id from a Roex webhook payload"""
+    data = payload.get("data")
+    for source in (payload, data if isinstance(data, dict) else {}):
+        for key in TASK_ID_KEYS:
+            if source.get(key):
+                return str(source[key])
+    return None
+
+async def forward_webhook(url: str, payload: Dict[str, Any]):
+    try:
+        response = await app.state.callback_http.post(url, content=orjson.dumps(payload), headers=JSON_HEADERS)
+        response.raise_for_status()
+    except httpx.HTTPError:
+        logger.exception("Webhook forwarding to %s failed", url)
+
+# Connection pool introspection, only enabled when DEBUG_TOKEN is set
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+
+@app.get("/debug/pools", include_in_schema=False)
+async def debug_pools(authorization: Optional[str] = Header(None)):
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    # Compare bytes: headers are decoded as latin-1 and compare_digest rejects non-ASCII str
+    if not authorization or not secrets.compare_digest(authorization.encode("latin-1"), f"Bearer {DEBUG_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    connections = app.state.http._transport._pool.connections
+    return {
+        "count": len(connections),
+        "connections": [connection.info() for connection in connections]
+    }
+
+# Health check endpoint: serialized once, the same response is returned to every probe
+HEALTH_RESPONSE = ORJSONResponse({"status": "healthy"})
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
+    return HEALTH_RESPONSE
 
 # File upload endpoint - gets signed URL from Roex
 @app.post("/upload/signed-url")
 async def get_upload_url(request: FileUploadRequest):
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{ROEX_API_BASE}/upload/signed-url",
-                headers={"Authorization": f"Bearer {roex_api_key}"},
-                json={
-                    "file_name": request.file_name,
-                    "content_type": request.content_type
-                }
-            )
-            response.raise_for_status()
-            return response.json()
-    except Exception as e:
-        logger.error(f"Upload URL generation failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    response = await app.state.http.post(
+        "/upload/signed-url",
+        content=orjson.dumps({
+            "file_name": request.file_name,
+            "content_type": request.content_type
+        }),
+        headers=JSON_HEADERS
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
 
 # Main audio processing endpoint
 @app.post("/process")
-async def process_audio(request: ProcessAudioRequest, background_tasks: BackgroundTasks):
-    try:
-        logger.info(f"Processing audio with service type: {request.service_type}")
-        
-        # Map service types to Roex operations
-        if request.service_type == "mastering_full":
-            return await process_mastering(request)
-        elif request.service_type == "mixing_full":
-            return await process_mixing(request)
-        elif request.service_type == "mix_enhance":
-            return await process_mix_enhancement(request)
-        elif request.service_type == "mix_analysis":
-            return await process_analysis(request)
-        elif request.service_type == "cleanup":
-            return await process_cleanup(request)
-        else:
-            raise HTTPException(status_code=400, detail=f"Unsupported service type: {request.service_type}")
-            
-    except Exception as e:
-        logger.error(f"Audio processing failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-async def process_mastering(request: ProcessAudioRequest):
-    """Process mastering using Roex HTTP API"""
-    try:
-        payload = {
-            "track_url": request.file_url,
-            "musical_style": request.musical_style.upper() if request.musical_style else "POP",
-            "desired_loudness": "MEDIUM",
-            "sample_rate": "44100"
-        }
-        
-        if request.webhook_url:
-            payload["webhook_url"] = request.webhook_url
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{ROEX_API_BASE}/mastering/preview",
-                headers={"Authorization": f"Bearer {roex_api_key}"},
-                json=payload
-            )
-            response.raise_for_status()
-            result = response.json()
-        
-        logger.info(f"Mastering task created: {result.get('mastering_task_id')}")
-        
-        return {
-            "success": True,
-            "job_id": result.get("mastering_task_id"),
-            "service_type": "mastering_full",
-            "status": "processing"
-        }
-        
-    except Exception as e:
-        logger.error(f"Mastering failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+async def process_audio(request: ProcessAudioRequest):
+    logger.debug("Processing audio with service type: %s", request.service_type)
+    
+    return await submit_job(request)
 
-async def process_mixing(request: ProcessAudioRequest):
-    """Process mixing using Roex HTTP API"""
-    try:
-        payload = {
-            "track_data": [{
-                "track_url": request.file_url,
-                "instrument_group": "VOCAL_GROUP",
-                "presence_setting": "LEAD",
-                "pan_preference": "CENTRE",
-                "reverb_preference": "LOW"
-            }],
-            "musical_style": request.musical_style.upper() if request.musical_style else "POP",
-            "return_stems": False
-        }
-        
-        if request.webhook_url:
-            payload["webhook_url"] = request.webhook_url
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{ROEX_API_BASE}/mix/preview",
-                headers={"Authorization": f"Bearer {roex_api_key}"},
-                json=payload
-            )
-            response.raise_for_status()
-            result = response.json()
-        
-        logger.info(f"Mix task created: {result.get('multitrack_task_id')}")
-        
-        return {
-            "success": True,
-            "job_id": result.get("multitrack_task_id"),
-            "service_type": "mixing_full",
-            "status": "processing"
-        }
-        
-    except Exception as e:
-        logger.error(f"Mixing failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+async def submit_job(request: ProcessAudioRequest):
+    """Submit a processing job using Roex HTTP API"""
+    service = ROEX_SERVICES[request.service_type]
+    payload = service.build_payload(request)
+    attach_webhook(payload, request)
+    
+    response = await app.state.http.post(service.submit_path, content=orjson.dumps(payload), headers=JSON_HEADERS)
+    response.raise_for_status()
+    job_id = orjson.loads(response.content).get(service.task_id_key)
+    
+    logger.debug("Task created for %s: %s", request.service_type, job_id)
+    
+    return {
+        "success": True,
+        "job_id": job_id,
+        "service_type": request.service_type,
+        "status": "processing"
+    }
 
-async def process_mix_enhancement(request: ProcessAudioRequest):
-    """Process mix enhancement using Roex HTTP API"""
-    try:
-        payload = {
-            "track_url": request.file_url
+async def request_job_status(service_type: str, job_id: str) -> Dict[str, Any]:
+    """Request job status from Roex HTTP API and cache the result"""
+    future = asyncio.get_running_loop().create_future()
+    # Quote the id into a single path segment; JobStatusRequest rejects the
+    # empty and dot-segment ids that would still escape it
+    path = ROEX_SERVICES[service_type].status_prefix + quote(job_id, safe="")
+    app.state.status_queue.put_nowait((path, future))
+    response = await future
+    key = (service_type, job_id)
+    
+    if response.status_code == 200:
+        result = {
+            "success": True,
+            "status": "completed",
+            "result": orjson.loads(response.content),
+            "job_id": job_id
         }
-        
-        if request.webhook_url:
-            payload["webhook_url"] = request.webhook_url
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{ROEX_API_BASE}/enhance",
-                headers={"Authorization": f"Bearer {roex_api_key}"},
-                json=payload
-            )
-            response.raise_for_status()
-            result = response.json()
-        
-        logger.info(f"Enhancement task created: {result.get('enhance_task_id')}")
-        
-        return {
+        DONE_CACHE[key] = result
+        await shared_set(f"roex:done:{job_id}", orjson.dumps(result), DONE_TTL)
+        return result
+    elif response.status_code == 202:
+        result = {
             "success": True,
-            "job_id": result.get("enhance_task_id"),
-            "service_type": "mix_enhance",
-            "status": "processing"
+            "status": "processing",
+            "job_id": job_id
         }
-        
-    except Exception as e:
-        logger.error(f"Mix enhancement failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    else:
+        result = {
+            "success": False,
+            "status": "failed",
+            "error": f"HTTP {response.status_code}",
+            "job_id": job_id
+        }
+    
+    STATUS_CACHE[key] = result
+    await shared_set(f"roex:status:{service_type}:{job_id}", orjson.dumps(result), STATUS_TTL)
+    return result
+
+async def fetch_job_status(service_type: str, job_id: str) -> Dict[str, Any]:
+    """Fetch job status for a /status poll, letting one worker poll Roex per window"""
+    redis = app.state.redis
+    # Distributed single-flight: only one worker polls Roex per job per window.
+    # If Redis is unavailable, poll anyway
+    if redis is not None:
+        try:
+            acquired = await redis.set(f"roex:poll:{service_type}:{job_id}", 1, nx=True, ex=STATUS_TTL)
+        except RedisError:
+            logger.warning("Redis poll lock for job %s failed, polling Roex directly", job_id, exc_info=True)
+            acquired = True
+        if not acquired:
+            return {
+                "success": True,
+                "status": "processing",
+                "job_id": job_id
+            }
+    
+    return await request_job_status(service_type, job_id)
+
+async def lookup_job_status(service_type: str, job_id: str) -> Dict[str, Any]:
+    """Serve job status from the caches, falling back to one shared Roex lookup"""
+    key = (service_type, job_id)
+    result = DONE_CACHE.get(key) or STATUS_CACHE.get(key)
+    if result is None:
+        result = await shared_job_status(service_type, job_id)
+    if result is None:
+        # Single-flight: concurrent polls for the same job share one upstream call
+        task = _status_inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch_job_status(service_type, job_id))
+            _status_inflight[key] = task
+            task.add_done_callback(lambda _: _status_inflight.pop(key, None))
+        result = await asyncio.shield(task)
+    return result
 
-async def process_analysis(request: ProcessAudioRequest):
-    """Process audio analysis using Roex HTTP API"""
+def settled_status(key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+    """Return the cached status for key if the job is no longer processing"""
+    result = DONE_CACHE.get(key) or STATUS_CACHE.get(key)
+    if result is not None and result["status"] != "processing":
+        return result
+    return None
+
+async def wait_for_webhook(service_type: str, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+    """Wait until Roex calls back for job_id, or until timeout expires"""
+    key = (service_type, job_id)
+    settled = settled_status(key)
+    if settled is not None:
+        return settled
+    
+    event = WEBHOOK_EVENTS.get(job_id)
+    if event is None:
+        event = asyncio.Event()
+        WEBHOOK_EVENTS[job_id] = event
+    
+    # The webhook may land on another worker: with Redis check the shared
+    # status every second, without it re-check Roex every few seconds
+    redis = app.state.redis
+    interval = 1.0 if redis is not None else STATUS_REPOLL_INTERVAL
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        try:
+            await asyncio.wait_for(event.wait(), min(remaining, interval))
+            return settled_status(key)
+        except asyncio.TimeoutError:
+            if redis is not None:
+                result = await shared_job_status(service_type, job_id)
+            else:
+                result = await lookup_job_status(service_type, job_id)
+            if result is not None and result["status"] != "processing":
+                return result
+
+async def handle_webhook(service_type: str, job_id: str, callback: str, payload: Dict[str, Any]):
+    """Refresh the job status after a Roex callback, wake waiters and notify the caller"""
+    # The callback is only a wake-up signal: the status itself comes from one
+    # Roex lookup, so failed tasks are not recorded as completed and results
+    # keep the same shape as the polling path
     try:
-        payload = {
-            "track_url": request.file_url
-        }
-        
-        if request.webhook_url:
-            payload["webhook_url"] = request.webhook_url
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{ROEX_API_BASE}/analysis",
-                headers={"Authorization": f"Bearer {roex_api_key}"},
-                json=payload
-            )
-            response.raise_for_status()
-            result = response.json()
-        
-        logger.info(f"Analysis task created: {result.get('analysis_task_id')}")
-        
-        return {
-            "success": True,
-            "job_id": result.get("analysis_task_id"),
-            "service_type": "mix_analysis",
-            "status": "processing"
-        }
-        
-    except Exception as e:
-        logger.error(f"Analysis failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        await request_job_status(service_type, job_id)
+    except Exception:
+        logger.exception("Status lookup after webhook for job %s failed", job_id)
+    finally:
+        # Waiters re-check the caches; if the lookup failed they keep polling
+        event = WEBHOOK_EVENTS.pop(job_id, None)
+        if event is not None:
+            event.set()
+    
+    if callback:
+        await forward_webhook(callback, payload)
 
-async def process_cleanup(request: ProcessAudioRequest):
-    """Process audio cleanup using Roex HTTP API"""
+# Roex completion callback
+@app.post("/roex/webhook")
+async def roex_webhook(request: Request, background_tasks: BackgroundTasks):
+    if not PUBLIC_BASE_URL:
+        raise HTTPException(status_code=404, detail="Not Found")
+    # Only URLs minted by attach_webhook carry a valid signature
+    service_type = request.query_params.get("service_type", "")
+    callback = request.query_params.get("callback", "")
+    sig = request.query_params.get("sig", "")
+    if not secrets.compare_digest(sig.encode(), webhook_signature(service_type, callback).encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if service_type not in ROEX_SERVICES:
+        raise HTTPException(status_code=400, detail="Unsupported service type")
+    
     try:
-        payload = {
-            "audio_file_location": request.file_url,
-            "sound_source": "VOCAL_GROUP"  # Default to vocal cleanup
-        }
-        
-        if request.webhook_url:
-            payload["webhook_url"] = request.webhook_url
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{ROEX_API_BASE}/cleanup",
-                headers={"Authorization": f"Bearer {roex_api_key}"},
-                json=payload
-            )
-            response.raise_for_status()
-            result = response.json()
-        
-        logger.info(f"Cleanup task created: {result.get('cleanup_task_id')}")
-        
-        return {
-            "success": True,
-            "job_id": result.get("cleanup_task_id"),
-            "service_type": "cleanup",
-            "status": "processing"
-        }
-        
-    except Exception as e:
-        logger.error(f"Cleanup failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Webhook payload is not valid JSON")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="Webhook payload must be a JSON object")
+    
+    job_id = webhook_job_id(payload)
+    if not job_id:
+        raise HTTPException(status_code=400, detail="Webhook payload has no task id")
+    
+    # Each job's callback is handled once; repeats are acknowledged and ignored
+    if not await first_webhook(job_id):
+        return {"success": True}
+    
+    logger.debug("Webhook received for job: %s", job_id)
+    
+    # Acknowledge Roex right away; the status lookup runs after the response
+    background_tasks.add_task(handle_webhook, service_type, job_id, callback, payload)
+    return {"success": True}
 
 # Job status endpoint
 @app.post("/status")
 async def get_job_status(request: JobStatusRequest):
-    try:
-        logger.info(f"Checking status for job: {request.job_id}, service: {request.service_type}")
-        
-        endpoint_map = {
-            "mastering_full": f"/mastering/preview/{request.job_id}",
-            "mixing_full": f"/mix/preview/{request.job_id}",
-            "mix_enhance": f"/enhance/{request.job_id}",
-            "mix_analysis": f"/analysis/{request.job_id}",
-            "cleanup": f"/cleanup/{request.job_id}"
-        }
-        
-        endpoint = endpoint_map.get(request.service_type)
-        if not endpoint:
-            raise HTTPException(status_code=400, detail=f"Unsupported service type: {request.service_type}")
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{ROEX_API_BASE}{endpoint}",
-                headers={"Authorization": f"Bearer {roex_api_key}"}
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return {
-                    "success": True,
-                    "status": "completed",
-                    "result": result,
-                    "job_id": request.job_id
-                }
-            elif response.status_code == 202:
-                return {
-                    "success": True,
-                    "status": "processing",
-                    "job_id": request.job_id
-                }
-            else:
-                return {
-                    "success": False,
-                    "status": "failed",
-                    "error": f"HTTP {response.status_code}",
-                    "job_id": request.job_id
-                }
-        
-    except Exception as e:
-        logger.error(f"Status check failed: {str(e)}")
-        return {
-            "success": False,
-            "status": "failed",
-            "error": str(e),
-            "job_id": request.job_id
-        }
+    logger.debug("Checking status for job: %s, service: %s", request.job_id, request.service_type)
+    
+    result = await lookup_job_status(request.service_type, request.job_id)
+    
+    # Long-poll: hold the request open until the webhook lands instead of
+    # making the client poll again
+    if result["status"] == "processing" and PUBLIC_BASE_URL and STATUS_LONG_POLL_TIMEOUT > 0:
+        settled = await wait_for_webhook(request.service_type, request.job_id, STATUS_LONG_POLL_TIMEOUT)
+        if settled is not None:
+            return settled
+    
+    return result
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        log_level="warning"
+    )
\ No newline at end of file